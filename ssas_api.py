@@ -8,9 +8,13 @@ Created on Wed Sep 20 16:59:43 2017
 import pandas as pd
 import numpy as np
 
+from contextlib import contextmanager
+import decimal
 from functools import wraps
 from pathlib import Path
 import logging
+import os
+import re
 import warnings
 
 logger = logging.getLogger(__name__)
@@ -24,6 +28,22 @@ except ImportError:
     """
     raise ImportError(msg)
 
+# set by _load_assemblies once the .Net assemblies are loaded and imported
+_ASSEMBLIES_LOADED = False
+DBNull = None  # System.DBNull
+
+
+def _latest_version_dir(path):
+    """
+    Returns the subfolder of `path` with the highest version, comparing versions
+    numerically. GAC folders are named like 'v4.0_15.0.0.0__89845dcd8080cc91'.
+    """
+    def version(entry):
+        return tuple(int(x) for x in re.findall(r"\d+", entry.name.split("__")[0]))
+
+    with os.scandir(path) as entries:
+        return Path(max((e for e in entries if e.is_dir()), key=version).path)
+
 
 def _load_assemblies(amo_path=None, adomd_path=None):
     """
@@ -49,12 +69,12 @@ def _load_assemblies(amo_path=None, adomd_path=None):
     # get latest version of libraries if multiple libraries are installed (max func)
     if amo_path is None:
         amo_path = str(
-            max((root / "Microsoft.AnalysisServices.Tabular").iterdir())
+            _latest_version_dir(root / "Microsoft.AnalysisServices.Tabular")
             / "Microsoft.AnalysisServices.Tabular.dll"
         )
     if adomd_path is None:
         adomd_path = str(
-            max((root / "Microsoft.AnalysisServices.AdomdClient").iterdir())
+            _latest_version_dir(root / "Microsoft.AnalysisServices.AdomdClient")
             / "Microsoft.AnalysisServices.AdomdClient.dll"
         )
 
@@ -66,13 +86,15 @@ def _load_assemblies(amo_path=None, adomd_path=None):
     clr.AddReference(adomd_path)
 
     # Only after loaded .Net assemblies
-    global System, DataTable, AMO, ADOMD
+    global System, DBNull, AMO, ADOMD, _ASSEMBLIES_LOADED
 
     import System
-    from System.Data import DataTable
+    from System import DBNull
     import Microsoft.AnalysisServices.Tabular as AMO
     import Microsoft.AnalysisServices.AdomdClient as ADOMD
 
+    _ASSEMBLIES_LOADED = True
+
     logger.info("Successfully loaded these .Net assemblies: ")
     for a in clr.ListAssemblies(True):
         logger.info(a.split(",")[0])
@@ -98,10 +120,7 @@ def _assert_dotnet_loaded(func):
     def wrapper(*args, **kwargs):
         amo_path = kwargs.pop("amo_path", None)
         adomd_path = kwargs.pop("adomd_path", None)
-        try:
-            type(DataTable)
-        except NameError:
-            # .NET assemblies not loaded/imported
+        if not _ASSEMBLIES_LOADED:
             logger.warning(".Net assemblies not loaded and imported, doing so now...")
             _load_assemblies(amo_path=amo_path, adomd_path=adomd_path)
         return func(*args, **kwargs)
@@ -124,7 +143,7 @@ def set_conn_string(server, db_name, username, password):
 
 
 @_assert_dotnet_loaded
-def get_DAX(connection_string, dax_string):
+def get_DAX(connection_string, dax_string, use_arrow=False, lazy=False):
     """
     Executes DAX query and returns the results as a pandas DataFrame
     
@@ -134,88 +153,296 @@ def get_DAX(connection_string, dax_string):
         Valid SSAS connection string, use the set_conn_string() method to set
     dax_string : string
         Valid DAX query, beginning with EVALUATE or VAR or DEFINE
+    use_arrow : bool, default False
+        Build the DataFrame through pyarrow (must be installed). Integer columns
+        with nulls then stay nullable integers (Int64) instead of becoming floats,
+        and Decimal columns become exact decimal.Decimal values. All other columns,
+        including integer columns without nulls and datetimes, get the same dtypes.
+    lazy : bool, default False
+        Return a LazyDAXResult instead, which only converts columns to pandas
+        when they are accessed. Call its to_pandas() method to get the DataFrame.
 
     Returns
     ----------------
-    pandas DataFrame with the results
+    pandas DataFrame with the results, or a LazyDAXResult if `lazy` is True
     """
-    table = _get_DAX(connection_string, dax_string)
-    df = _parse_DAX_result(table)
+    names, type_names, columns = _get_DAX(connection_string, dax_string)
+    if lazy:
+        return LazyDAXResult(names, type_names, columns, use_arrow=use_arrow)
+    df = _parse_DAX_result(names, type_names, columns, use_arrow=use_arrow)
     return df
 
 
-def _get_DAX(connection_string, dax_string) -> "DataTable":
-    dataadapter = ADOMD.AdomdDataAdapter(dax_string, connection_string)
-    table = DataTable()
+def _get_DAX(connection_string, dax_string):
+    """
+    Streams the DAX query results out of a data reader, rather than buffering
+    them all in a .Net DataTable first.
+    Returns the column names, their .Net type names, and a list of values per column
+    """
+    conn = ADOMD.AdomdConnection(connection_string)
     logger.info("Getting DAX query...")
-    dataadapter.Fill(table)
+    conn.Open()
+    try:
+        cmd = conn.CreateCommand()
+        cmd.CommandText = dax_string
+        reader = cmd.ExecuteReader()
+        try:
+            field_count = reader.FieldCount
+            names = [reader.GetName(i) for i in range(field_count)]
+            type_names = [reader.GetFieldType(i).FullName for i in range(field_count)]
+            columns = [[] for _ in range(field_count)]
+            appends = [col.append for col in columns]
+            # marshal each row from .Net in a single call, straight into its columns
+            row = System.Array[System.Object]([None] * field_count)
+            while reader.Read():
+                reader.GetValues(row)
+                for append, v in zip(appends, row):
+                    append(v)
+        finally:
+            reader.Close()
+    finally:
+        conn.Close()
     logger.info("DAX query successfully retrieved")
-    return table
-
-
-def _parse_DAX_result(table: "DataTable") -> pd.DataFrame:
-    cols = [c for c in table.Columns.List]
-    rows = []
-    # much better performance to just access data by position instead of name
-    # and then add column names afterwards
-    for r in range(table.Rows.Count):
-        row = [table.Rows[r][c] for c in cols]
-        rows.append(row)
-
-    df = pd.DataFrame.from_records(rows, columns=[c.ColumnName for c in cols])
-
-    # replace System.DBNull with None
-    # df.replace({System.DBNull: np.NaN}) doesn't work for some reason
-    df = df.applymap(lambda x: np.NaN if isinstance(x, System.DBNull) else x)
-
-    # convert datetimes
-    dt_types = [c.ColumnName for c in cols if c.DataType.FullName == "System.DateTime"]
-    if dt_types:
-        for dtt in dt_types:
-            # if all nulls, then pd.to_datetime will fail
-            if not df.loc[:, dtt].isna().all():
-                # https://docs.microsoft.com/en-us/dotnet/standard/base-types/standard-date-and-time-format-strings#Sortable
-                ser = df.loc[:, dtt].map(lambda x: x.ToString('s'))
-                df.loc[:, dtt] = pd.to_datetime(ser)
-
-    # convert other types
-    types_map = {"System.Int64": int, "System.Double": float, "System.String": str}
-    col_types = {c.ColumnName: types_map.get(c.DataType.FullName, "object") for c in cols}
-    
-    # handle NaNs (which are floats, as of pandas v.0.25.3) in int columns
-    col_types_ints = {k for k,v in col_types.items() if v == int}
-    ser = df.isna().any(axis=0)
-    col_types.update({k:float for k in set(ser[ser].index).intersection(col_types_ints)})
-    
-    # convert
-    df = df.astype(col_types)
+    return names, type_names, columns
+
 
+# .Net ticks are 100 nanosecond intervals since 0001-01-01, this is the unix epoch in ticks
+_UNIX_EPOCH_TICKS = 621355968000000000
+
+
+def _ticks_to_datetime(ticks: np.ndarray, nulls: np.ndarray) -> pd.DatetimeIndex:
+    # truncate to microseconds, pandas raises OutOfBoundsDatetime for dates it can't hold
+    dt = pd.to_datetime((ticks - _UNIX_EPOCH_TICKS) // 10, unit="us")
+    return dt.where(~nulls)
+
+
+# numpy dtypes to extract .Net column types into, any other type is kept as object
+_DTYPES = {
+    "System.Int64": np.int64,
+    "System.Double": np.float64,
+    "System.DateTime": np.int64,  # as ticks
+}
+# placeholder for nulls while extracting, the null mask is what marks them as missing
+_NULL_FILLS = {"System.Int64": 0, "System.DateTime": _UNIX_EPOCH_TICKS}
+# .Net values that need converting before they fit in their numpy dtype
+_CONVERTERS = {"System.DateTime": lambda v: v.Ticks}
+
+
+def _column_to_array(values, type_name: str):
+    """
+    Extracts one column of .Net values into a typed numpy array, along with its null mask
+    """
+    dbnull = DBNull
+    arr = np.full(
+        len(values), _NULL_FILLS.get(type_name, np.nan), dtype=_DTYPES.get(type_name, object)
+    )
+    nulls = np.zeros(len(values), dtype=bool)
+    convert = _CONVERTERS.get(type_name)
+    for r, v in enumerate(values):
+        # DBNull is sealed, so an exact type check is enough and cheaper than isinstance.
+        # Can't use `v is DBNull.Value`, pythonnet hands back a new wrapper each time
+        if type(v) is dbnull:
+            nulls[r] = True
+        else:
+            arr[r] = v if convert is None else convert(v)
+    return arr, nulls
+
+
+def _finalize_column(values: np.ndarray, nulls: np.ndarray, type_name: str):
+    if type_name == "System.DateTime":
+        return _ticks_to_datetime(values, nulls)
+    if type_name == "System.Int64" and nulls.any():
+        # handle NaNs (which are floats) in int columns
+        values = values.astype(float)
+        values[nulls] = np.nan
+    return values
+
+
+def _to_arrow_frame(names, type_names, arrays) -> pd.DataFrame:
+    """
+    Builds the DataFrame through a pyarrow RecordBatch. Int columns with nulls become
+    nullable Int64, Decimal columns become exact decimals, and columns of .Net objects
+    pyarrow can't convert stay object columns, the same as without pyarrow.
+
+    >>> df = _to_arrow_frame(
+    ...     ["amount", "count", "other"],
+    ...     ["System.Double", "System.Int64", "System.Object"],
+    ...     [
+    ...         (np.array([1.5, np.nan]), np.array([False, True])),
+    ...         (np.array([1, 0]), np.array([False, True])),
+    ...         (np.array([object(), np.nan], dtype=object), np.array([False, True])),
+    ...     ],
+    ... )
+    >>> df.dtypes.tolist()
+    [dtype('float64'), Int64Dtype(), dtype('O')]
+    >>> df["count"].tolist()
+    [1, <NA>]
+    """
+    try:
+        import pyarrow as pa
+    except ImportError:
+        msg = """
+        Could not import 'pyarrow', install it to use `use_arrow=True`.
+        For conda, `conda install -c conda-forge pyarrow`
+        """
+        raise ImportError(msg)
+
+    def arrow_column(values, nulls, type_name):
+        if type_name == "System.String":
+            return pa.array(values, mask=nulls, type=pa.string())
+        elif type_name == "System.Decimal":
+            # pythonnet doesn't convert System.Decimal, go through its exact string form
+            culture = System.Globalization.CultureInfo.InvariantCulture
+            return pa.array(
+                [
+                    None if null else decimal.Decimal(v.ToString(culture))
+                    for v, null in zip(values, nulls)
+                ]
+            )
+        return pa.array(values, mask=nulls)
+
+    batch_names, batch_columns, others = [], [], {}
+    for name, t, (values, nulls) in zip(names, type_names, arrays):
+        if t == "System.Int64" and nulls.any():
+            # keep nulls in int columns as a nullable int instead of converting to float
+            others[name] = pd.arrays.IntegerArray(values, nulls)
+            continue
+        if t == "System.DateTime":
+            # same conversion as without pyarrow, so datetimes get the same dtype either way
+            others[name] = _ticks_to_datetime(values, nulls)
+            continue
+        try:
+            batch_columns.append(arrow_column(values, nulls, t))
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            others[name] = _finalize_column(values, nulls, t)
+            continue
+        batch_names.append(name)
+
+    batch = pa.RecordBatch.from_arrays(batch_columns, names=batch_names)
+    df = batch.to_pandas(self_destruct=True)
+    for name, values in others.items():
+        df[name] = values
+    return df[names]
+
+
+def _parse_DAX_result(names, type_names, columns, use_arrow=False) -> pd.DataFrame:
+    # extract each column straight into a typed array, tracking nulls as we go,
+    # so the frame doesn't need any further datetime or astype passes
+    arrays = [_column_to_array(values, t) for values, t in zip(columns, type_names)]
+    if use_arrow:
+        return _to_arrow_frame(names, type_names, arrays)
+
+    data = {
+        name: _finalize_column(values, nulls, t)
+        for name, t, (values, nulls) in zip(names, type_names, arrays)
+    }
+    df = pd.DataFrame(data, columns=names, copy=False)
     return df
 
 
+class LazyDAXResult:
+    """
+    Results of a DAX query that are only converted to pandas when accessed,
+    one column at a time with `result[column_name]`, or all at once with `to_pandas()`.
+    Converted columns are cached.
+
+    >>> result = LazyDAXResult(["a", "b"], ["System.Int64", "System.String"], [[1, 2], ["x", "y"]])
+    >>> list(result), "a" in result, "c" in result, len(result)
+    (['a', 'b'], True, False, 2)
+    >>> result["a"].tolist()
+    [1, 2]
+    >>> result["a"] is result["a"]
+    True
+    >>> result.to_pandas().shape
+    (2, 2)
+    """
+
+    def __init__(self, names, type_names, columns, use_arrow=False):
+        self._type_names = dict(zip(names, type_names))
+        self._columns = dict(zip(names, columns))
+        self._use_arrow = use_arrow
+        self._cache = {}
+
+    @property
+    def columns(self):
+        return list(self._columns)
+
+    def __len__(self):
+        return len(next(iter(self._columns.values()), []))
+
+    def __iter__(self):
+        return iter(self._columns)
+
+    def __contains__(self, name):
+        return name in self._columns
+
+    def __getitem__(self, name) -> pd.Series:
+        if name not in self._cache:
+            self._cache[name] = self._materialize(name)
+        return self._cache[name]
+
+    def _materialize(self, name) -> pd.Series:
+        df = _parse_DAX_result(
+            [name], [self._type_names[name]], [self._columns[name]], use_arrow=self._use_arrow
+        )
+        return df[name]
+
+    def to_pandas(self) -> pd.DataFrame:
+        return pd.DataFrame({name: self[name] for name in self.columns})
+
+
+@contextmanager
+@_assert_dotnet_loaded
+def ssas_session(connection_string):
+    """
+    Context manager that connects to the SSAS server once and yields the AMO Server,
+    so several process_* calls can reuse the same connection by passing it as `server`.
+    Disconnects on exit.
+
+    Example:
+        .. code-block:: python
+
+            with ssas_api.ssas_session(conn) as server:
+                ssas_api.process_table(conn, 'Table1', 'full', 'MyModel', server=server)
+                ssas_api.process_table(conn, 'Table2', 'full', 'MyModel', server=server)
+    """
+    AMOServer = AMO.Server()
+    logger.info("Connecting to database...")
+    AMOServer.Connect(connection_string)
+    try:
+        yield AMOServer
+    finally:
+        logger.info("Disconnecting from Database...")
+        AMOServer.Disconnect()
+
+
 @_assert_dotnet_loaded
-def process_database(connection_string, refresh_type, db_name):
+def process_database(connection_string, refresh_type, db_name, server=None):
     process_model(
         connection_string=connection_string,
         item_type="model",
         refresh_type=refresh_type,
         db_name=db_name,
+        server=server,
     )
 
 
 @_assert_dotnet_loaded
-def process_table(connection_string, table_name, refresh_type, db_name):
+def process_table(connection_string, table_name, refresh_type, db_name, server=None):
     process_model(
         connection_string=connection_string,
         item_type="table",
         item=table_name,
         refresh_type=refresh_type,
         db_name=db_name,
+        server=server,
     )
 
 
 @_assert_dotnet_loaded
-def process_model(connection_string, db_name, refresh_type="full", item_type="model", item=None):
+def process_model(
+    connection_string, db_name, refresh_type="full", item_type="model", item=None, server=None
+):
     """
     Processes SSAS data model to get new data from underlying source.
     
@@ -230,21 +457,26 @@ def process_model(connection_string, db_name, refresh_type="full", item_type="mo
     item_type : string, choice of {'model','table'}, default 'model'
     item : string, optional.
         Then name of the item. Only needed when item_type is 'table', to specify the table name
+    server : AMO Server, optional.
+        An already connected server from ssas_session(), to reuse its connection.
+        If None, connects to `connection_string` just for this call.
     """
     assert item_type.lower() in ("table", "model"), f"Invalid item type: {item_type}"
     if item_type.lower() == "table" and not item:
         raise ValueError("If item_type is table, must supply an item (a table name) to process")
 
-    # connect to the AS instance from Python
-    AMOServer = AMO.Server()
-    logger.info("Connecting to database...")
-    AMOServer.Connect(connection_string)
+    if server is None:
+        # connect to the AS instance from Python just for this refresh
+        with ssas_session(connection_string) as server:
+            return process_model(
+                connection_string, db_name, refresh_type, item_type, item, server=server
+            )
 
     # Dict of refresh types
     refresh_dict = {"full": AMO.RefreshType.Full}
 
     # process
-    db = AMOServer.Databases[db_name]
+    db = server.Databases[db_name]
 
     if item_type.lower() == "table":
         table = db.Model.Tables.Find(item)
@@ -255,7 +487,3 @@ def process_model(connection_string, db_name, refresh_type="full", item_type="mo
     op_result = db.Model.SaveChanges()
     if op_result.Impact.IsEmpty:
         logger.info("No objects affected by the refresh")
-
-    logger.info("Disconnecting from Database...")
-    # Disconnect
-    AMOServer.Disconnect()